@@ -18,11 +18,13 @@ from panda3d.core import AmbientLight, Trackball, MouseButton, TextFont
 from panda3d.core import CollisionNode, CollisionBox, CollisionEntry
 from panda3d.core import CollisionTraverser, CollisionHandlerEvent
 from panda3d.core import loadPrcFile
-from panda3d.core import TextNode, NodePath
-from panda3d.core import Vec3
+from panda3d.core import TextNode, NodePath, NodePathCollection
+from panda3d.core import Point3, Vec3
 # Mouse
 from pynput.mouse import Controller as MouseController
 # Other
+import numpy as np
+import re
 from random import choices, randint
 from string import ascii_letters
 import sys
@@ -30,6 +32,11 @@ import sys
 # Load configuration
 loadPrcFile("config/conf.prc")
 
+# Matches names of small cubes
+CUBE_COLOR_PATTERN = re.compile(r"WHITE|YELLOW|RED|BLUE|GREEN|ORANGE")
+# Keys printed on screen
+ASCII_LETTERS = frozenset(ascii_letters)
+
 class MyGame(ShowBase):
     """Game Class"""
     def __init__(self, debug=False):
@@ -49,8 +56,16 @@ class MyGame(ShowBase):
         self.randomizing = False
 
         # Print last pressed key
-        self.pressed_button = OnscreenText()
-        self.info_on_screen = OnscreenText()
+        self.pressed_button: OnscreenText = self.gen_label_text("", 0)
+        self.info_on_screen = OnscreenText(
+            text="", parent=self.a2dBottomCenter,
+            pos=(0, 0.2), fg=(1, 1, 1, 1),
+            align=TextNode.ACenter, shadow=(0, 0, 0, 0.5), scale=.05
+        )
+
+        # Load font of side labels
+        self.font = self.loader.loadFont('./fonts/party.ttf')
+        self.font.setRenderMode(TextFont.RMTexture)
 
         # Load rubik's cube model
         self.cube_model = self.loader.loadModel('./models/rubiks.bam')
@@ -172,16 +187,43 @@ class MyGame(ShowBase):
             }
         }
 
-        self.collided_cubes = set()
+        self.collided_cubes = []
         for mapping_side in self.mapping_sides.values():
             mapping_side["handler"].addInPattern(mapping_side["pattern"])
+            # Cache rotations for both directions
+            mapping_side["rotation_pos"] = Vec3(mapping_side["rotation"])
+            mapping_side["rotation_neg"] = mapping_side["rotation"] * -1
+
+        # Map lowercase keys to side names
+        self.key_to_side = {
+            side["key"]: name for name, side in self.mapping_sides.items()
+        }
+
+        # Camera views by key
+        self.look_at_sides = {
+            "1": ("Front", Vec3(0, 0, 0)),
+            "2": ("Back", Vec3(0, 180, 180)),
+            "3": ("Left", Vec3(90, 0, 0)),
+            "4": ("Right", Vec3(-90, 0, 0)),
+            "5": ("Top", Vec3(0, 90, 0)),
+            "6": ("Bottom", Vec3(0, -90, 0)),
+        }
 
         # Create side colliders
         self.create_side_colliders()
 
+        # Traverser and handler of every side
+        self.trav_handler_pairs = [
+            (side["trav"], side["handler"])
+            for side in self.mapping_sides.values()
+        ]
+
         # Create box colliders
         self.create_box_colliders()
 
+        # Cubes belonging to each side, used while randomizing
+        self.side_members = {}
+
         # Rotate sides
         self.buttonThrowers[0].node().setKeystrokeEvent('keystroke')
 
@@ -199,9 +241,6 @@ class MyGame(ShowBase):
         self.draw_3d_text()
 
     def draw_3d_text(self):
-        self.font = self.loader.loadFont('./fonts/party.ttf')
-        self.font.setRenderMode(TextFont.RMTexture)
-
         for side in self.mapping_sides.values():
             text = side['key'].upper()
             textlabel = TextNode(text)
@@ -235,9 +274,8 @@ class MyGame(ShowBase):
                 side.hide()
 
             cNode = CollisionNode(name)
-            cNode.addSolid(
-                CollisionBox(side.getTightBounds()[0], side.getTightBounds()[1])
-            )
+            bmin, bmax = side.getTightBounds()
+            cNode.addSolid(CollisionBox(bmin, bmax))
             sideC = side.attachNewNode(cNode)
 
             if self.debug_mode:
@@ -248,6 +286,8 @@ class MyGame(ShowBase):
             # Add side collider
             map_side = self.mapping_sides[name]
             map_side['node_path'] = side
+            map_side['collider'] = sideC
+            map_side['bounds'] = (np.array(bmin), np.array(bmax))
             traverser, handler = map_side["trav"], map_side["handler"]
             traverser.addCollider(sideC, handler)
 
@@ -257,142 +297,137 @@ class MyGame(ShowBase):
 
     def create_box_colliders(self):
         """ Create box colliders """
-        whites = self.cube_model.find_all_matches("*WHITE*")
-        yellows = self.cube_model.find_all_matches("*YELLOW*")
-        reds = self.cube_model.find_all_matches("*RED*")
-        blues = self.cube_model.find_all_matches("*BLUE*")
-        greens = self.cube_model.find_all_matches("*GREEN*")
-        orange = self.cube_model.find_all_matches("*ORANGE*")
-
-        self.cubes = {*whites, *yellows, *reds, *blues, *greens, *orange}
-        for num, cube in enumerate(self.cubes):
+        self.cubes = {
+            child for child in self.cube_model.getChildren()
+            if CUBE_COLOR_PATTERN.search(child.getName())
+        }
+        cubes = list(self.cubes)
+        self.cube_centers = []
+
+        # Gather tight bounds of all cubes
+        mins = np.empty((len(cubes), 3))
+        maxs = np.empty_like(mins)
+        for i, cube in enumerate(cubes):
+            mins[i], maxs[i] = cube.getTightBounds()
+
+        # Scale BoxColliders smaller than cubes
+        mins += 0.2
+        maxs -= 0.2
+        # Cubes are cubic, so turns don't change their half sizes
+        self.cube_half_sizes = (maxs - mins) / 2
+
+        for cube, bmin, bmax in zip(cubes, mins, maxs):
             cube: NodePath
 
             if self.debug_mode:
                 cube.showTightBounds()
             cCubeNode = CollisionNode(cube.name)
-            min, max = cube.getTightBounds()
-
-            # Scale BoxCollider smaller than cube
-            min[0] += 0.2
-            min[1] += 0.2
-            min[2] += 0.2
-
-            max[0] -= 0.2
-            max[1] -= 0.2
-            max[2] -= 0.2
-
-            cCubeNode.addSolid(CollisionBox(min, max))
+            cCubeNode.addSolid(CollisionBox(Point3(*bmin), Point3(*bmax)))
             cCube = cube.attachNewNode(cCubeNode)
             if self.debug_mode:
                 cCube.show()
 
+            # Keep cube center in its own space
+            center = Point3(*((bmin + bmax) / 2))
+            self.cube_centers.append(
+                (cube, cube.getRelativePoint(self.cube_model, center))
+            )
+
             # Add current cube collider for each traverser and set handler
-            for mapping_side in self.mapping_sides.values():
-                traverser = mapping_side["trav"]
-                handler = mapping_side["handler"]
+            for traverser, handler in self.trav_handler_pairs:
                 traverser.addCollider(cCube, handler)
 
     def force_traverse(self, key):
         """ Force traverses by key"""
         # Set rotate direction
         print("Key:", key)
-        if key.isupper():
-            self.direction = -1
-        else:
-            self.direction = 1
-
-        if key in ["t", "T"]:
-            self.top_traverser.traverse(self.render)
-
-        elif key in ["d", "D"]:
-            self.bottom_traverser.traverse(self.render)
-
-        elif key in ["l", "L"]:
-            self.left_traverser.traverse(self.render)
-
-        elif key in ["r", "R"]:
-            self.right_traverser.traverse(self.render)
-
-        elif key in ["f", "F"]:
-            self.front_traverser.traverse(self.render)
-
-        elif key in ["b", "B"]:
-            self.back_traverser.traverse(self.render)
-
-        elif key in ["h", "H"]:
-            self.center_hori_traverser.traverse(self.render)
-
-        elif key in ["v", "V"]:
-            self.center_vert_traverser.traverse(self.render)
-
-        elif key in ["c", "C"]:
-            self.center_double_traverser.traverse(self.render)
-
+        self.direction = -1 if key.isupper() else 1
+
+        name = self.key_to_side.get(key.lower())
+        if name is not None:
+            if self.randomizing:
+                # Only scramble moves get here, user keys are not accepted
+                # until the scramble ends. Skip collisions for them.
+                self.rotate_side_by_members(name)
+                return True
+            side = self.mapping_sides[name]
+            side["trav"].traverse(self.render)
+            # Forget current contacts, so next traverse throws 'in' events
+            side["handler"].clear()
         else:
             if key == ' ':
                 self.randomize()
             elif key in ["1", "2", "3", "4", "5", "6", "7"]:
                 self.look_at_cube_side(key)
                 # No traverser has been activated.
-            self.accept_once("keystroke", self.force_collisions)
+            if not self.randomizing:
+                # Ignore user keys while randomizing
+                self.accept_once("keystroke", self.force_collisions)
         return True
 
     def force_collisions(self, key: str):
         """ Force traversers """
         self.force_traverse(key=key)
-        for cube in self.cubes:
-            cube.setFluidPos(cube.getX() + 15, cube.getY() + 15, cube.getZ() + 15)
-        self.force_traverse(key=key)
-        for cube in self.cubes:
-            cube.setFluidPos(cube.getX() - 15, cube.getY() - 15, cube.getZ() - 15)
         self.print_key_on_screen(keyname=key)
 
     def print_key_on_screen(self, keyname):
         """ Handling a keystroke on the keyboard. """
-        if keyname in ascii_letters:
-            self.pressed_button.destroy()
-            self.pressed_button: OnscreenText = self.gen_label_text(keyname, 0)
+        if keyname in ASCII_LETTERS:
+            self.pressed_button.setText(keyname)
         return True
 
     def print_info_on_screen(self, msg, i=3):
         """ Handling a keystroke on the keyboard. """
-        self.info_on_screen.destroy()
-        self.info_on_screen = OnscreenText(
-            text=msg, parent=self.a2dBottomCenter,
-            pos=(0, 0.2), fg=(1, 1, 1, 1),
-            align=TextNode.ACenter, shadow=(0, 0, 0, 0.5), scale=.05
-        )
-
+        self.info_on_screen.setText(msg)
         return True
 
     def rotate_side(self, coll_entry):
         """ Rotate selected side """
         pivot: NodePath = coll_entry.getIntoNodePath()  # get big box
-        name = pivot.getName()
-        cubes = self.collided_cubes.copy()  # list of small cubes NodePaths
+        cubes = list(self.collided_cubes)  # list of small cubes NodePaths
+        self.rotate_cubes(pivot, cubes)
+
+    def rotate_side_by_members(self, name):
+        """ Rotate selected side without collision detection """
+        pivot: NodePath = self.mapping_sides[name]['collider']
+        cubes = list(self.side_members[name])
+        self.rotate_cubes(pivot, cubes)
+
+    def rotate_cubes(self, pivot, cubes):
+        """ Rotate cubes around side pivot """
+        rotation = self.get_rotation(pivot.getName())
         pivot.clearTransform()
 
         pivot.show()
         pivot.getParent().show()
+        cubes_paths = NodePathCollection()
         for cubo in cubes:
-            cubo.wrtReparentTo(pivot)  # re-parent small boxes to big box
-            cubo.show()
+            cubes_paths.addPath(cubo)
+        cubes_paths.wrtReparentTo(pivot)  # re-parent small boxes to big box
+        cubes_paths.show()
 
-        self.seq = Sequence()
         if self.animate:
-            hprInterval = pivot.hprInterval(
-                0.28, self.mapping_sides[name]['rotation'] * self.direction
+            self.seq = Sequence(
+                pivot.hprInterval(0.28, rotation),
+                Func(self.reparent_cubes, pivot, cubes_paths),
+                Func(self.reset, cubes),
             )
-            self.seq.append(hprInterval)
+            self.seq.start()
         else:
-            self.seq.append(Func(self.rotate_without_anim, name, pivot))
-        self.seq.append(Func(self.reparent_cubes, pivot, cubes))
-        self.seq.append(Func(self.reset, cubes))
-        self.seq.start()
+            # Finish at once, so next move sees updated sides
+            self.rotate_without_anim(pivot, rotation)
+            self.reparent_cubes(pivot, cubes_paths)
+            self.reset(cubes)
 
-    def rotate_without_anim(self, name, pivot):
-        pivot.setHpr(self.mapping_sides[name]['rotation'] * self.direction)
+    def get_rotation(self, name):
+        """ Get cached side rotation for current direction """
+        side = self.mapping_sides[name]
+        if self.direction > 0:
+            return side['rotation_pos']
+        return side['rotation_neg']
+
+    def rotate_without_anim(self, pivot, rotation):
+        pivot.setHpr(rotation)
 
     def reset(self, cubes):
         cubes.clear()
@@ -400,11 +435,30 @@ class MyGame(ShowBase):
         if not self.randomizing:
             self.accept_once("keystroke", self.force_collisions)
 
-    def reparent_cubes(self, pivot, cubes):
+    def reparent_cubes(self, pivot, cubes_paths):
         pivot.getParent().hide()
         pivot.hide()
-        for cube in cubes:
-            cube.wrtReparentTo(self.cube_model)
+        cubes_paths.wrtReparentTo(self.cube_model)
+        if self.randomizing:
+            self.update_side_members()
+
+    def update_side_members(self):
+        """ Assign cubes to sides whose bounds overlap their boxes """
+        get_relative_point = self.cube_model.getRelativePoint
+        centers = np.array([
+            get_relative_point(cube, center)
+            for cube, center in self.cube_centers
+        ])
+        for name, side in self.mapping_sides.items():
+            bmin, bmax = side['bounds']
+            overlap = np.all(
+                (centers - self.cube_half_sizes < bmax)
+                & (centers + self.cube_half_sizes > bmin),
+                axis=1
+            )
+            self.side_members[name] = [
+                cube for (cube, _), hit in zip(self.cube_centers, overlap) if hit
+            ]
 
     def collide(self, num: int, collEntry: CollisionEntry):
         """ Collide with side """
@@ -413,7 +467,7 @@ class MyGame(ShowBase):
             side_node = collEntry.getIntoNodePath()
             print(F" -- {side_node.getName()}  ::  {cude_node.getName()}")
 
-        self.collided_cubes.add(cude_node)
+        self.collided_cubes.append(cude_node)
 
         if len(self.collided_cubes) >= num:
             # Rotate selected side of cube
@@ -423,30 +477,15 @@ class MyGame(ShowBase):
     def look_at_cube_side(self, key):
         """ Set cam to look at chosen cube side"""
         tb = self.trackball.node()
-        if key == "1":
-            tmp_txt = "Front"
-            tmp_hpr = (0, 0, 0)
-        elif key == "2":
-            tmp_txt = "Back"
-            tmp_hpr = (0, 180, 180)
-        elif key == "3":
-            tmp_txt = "Left"
-            tmp_hpr = (90, 0, 0)
-        elif key == "4":
-            tmp_txt = "Right"
-            tmp_hpr = (-90, 0, 0)
-        elif key == "5":
-            tmp_txt = "Top"
-            tmp_hpr = (0, 90, 0)
-        elif key == "6":
-            tmp_txt = "Bottom"
-            tmp_hpr = (0, -90, 0)
+        look_at = self.look_at_sides.get(key)
+        if look_at is not None:
+            tmp_txt, tmp_hpr = look_at
         else:
             tmp_txt = "Opposite side"
             tmp_hpr = tb.getHpr()
             tmp_hpr[2] -= 90
 
-        tb.setHpr(*tmp_hpr)
+        tb.setHpr(tmp_hpr)
         self.print_info_on_screen(tmp_txt)
 
     def gen_label_text(self, text, i):
@@ -472,18 +511,18 @@ class MyGame(ShowBase):
         print("Space")
         if not self.randomizing:
             self.randomizing = True
+            self.update_side_members()
             for x in self.mapping_sides.values():
                 keys.append(x['key'])
                 keys.append(x['key'].upper())
             choosed_keys = choices(keys, k=randint(30, 60))
-            random_seq = Sequence()
-            random_seq.append(Func(self.turn_on_off_anmiate, False))
-            random_seq.append(Wait(1.0))
-            for key in choosed_keys:
-                random_seq.append(Func(self.force_collisions, key))
-                random_seq.append(Wait(0.15))
-            random_seq.append(Func(self.turn_on_off_anmiate, True))
-            random_seq.append(Func(self.turn_of_randomize))
+            intervals = [Func(self.turn_on_off_anmiate, False), Wait(1.0)]
+            intervals += [
+                Func(self.force_collisions, key) for key in choosed_keys
+            ]
+            intervals.append(Func(self.turn_on_off_anmiate, True))
+            intervals.append(Func(self.turn_of_randomize))
+            random_seq = Sequence(*intervals)
             random_seq.start()
 
 